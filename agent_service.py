@@ -1,8 +1,53 @@
-import requests
+import asyncio
+import httpx
 import subprocess
-import json
+import logging
+import orjson
 import os
-from typing import List, Dict, Tuple, Optional
+import time
+import google.auth.transport.requests
+import google.oauth2.id_token
+from google.auth import exceptions as google_auth_exceptions
+from google.auth import jwt as google_jwt
+from collections import defaultdict
+from typing import AsyncIterator, DefaultDict, List, Dict, Tuple, Optional
+
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO; keep that out of the per-request hot path
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Transient Cloud Run gateway errors worth retrying on idempotent calls.
+RETRY_STATUSES = {502, 503, 504}
+RETRY_TRANSPORT_ERRORS = (httpx.ConnectError, httpx.RemoteProtocolError)
+MAX_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 0.2
+
+SSE_DATA_PREFIX = b'data: '
+
+# Abort the agent stream if no bytes arrive for this long once the body is flowing,
+# instead of holding the request for the full 300s when Cloud Run stalls mid-stream.
+# Waiting for the response itself (e.g. an agent cold start) keeps the 300s limit.
+SSE_READ_IDLE_TIMEOUT_SECONDS = 30
+
+# Upper bound on how long startup waits for the agent warm-up request.
+WARM_UP_TIMEOUT_SECONDS = 5.0
+
+# Refresh the cached identity token this long before it actually expires.
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+
+def _build_headers(auth_token: str) -> Dict[str, Dict[str, str]]:
+    """
+    Builds the request header variants used with the agent for a given token.
+    """
+    auth_headers = {"Authorization": f"Bearer {auth_token}"}
+    json_headers = {**auth_headers, "Content-Type": "application/json"}
+    sse_headers = {**json_headers, "Accept": "text/event-stream"}
+    return {"auth": auth_headers, "json": json_headers, "sse": sse_headers}
+
+class AgentTimeoutError(Exception):
+    """
+    Raised when the agent stops sending data for longer than the read-idle timeout.
+    """
 
 class AgentService:
     """
@@ -16,11 +61,90 @@ class AgentService:
         """
         self.cloud_run_url = "https://papers-rag-1-master-1031636165462.us-central1.run.app"
         self.app_name = "papers-rag-agent"
+        self.client: Optional[httpx.AsyncClient] = None
+        self._auth_request = google.auth.transport.requests.Request()
+        self._auth_token: Optional[str] = None
+        self._auth_token_expiry: float = 0.0
+        self._auth_headers: Dict[str, Dict[str, str]] = {}
+        self._auth_token_lock = asyncio.Lock()
+        # user_id -> agent session_id, so returning users skip the list-sessions round-trip.
+        self._session_cache: Dict[str, str] = {}
+        # Per-user locks so one user's list/create round-trips never block another user.
+        self._session_locks: DefaultDict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def start(self):
+        """
+        Open the shared HTTP client used for all calls to the agent. HTTP/2 lets the
+        session calls and concurrent /run_sse streams share one TLS connection.
+        Must be called from within the running event loop (FastAPI startup).
+        """
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                http2=True,
+                timeout=httpx.Timeout(300.0),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=75)
+            )
+
+    async def close(self):
+        """
+        Close the shared HTTP client (FastAPI shutdown).
+        """
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def warm_up(self):
+        """
+        Best-effort warm-up on startup: fetches the identity token and opens the
+        TLS connection to the agent so the first user request doesn't pay for either.
+        Capped at WARM_UP_TIMEOUT_SECONDS in total so a slow credential path or agent
+        cannot delay worker readiness.
+        """
+        async def prime():
+            token = await self.get_gcloud_auth_token()
+            await self.client.get(f"{self.cloud_run_url}/health", headers=self._headers(token))
+
+        try:
+            await asyncio.wait_for(prime(), WARM_UP_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.warning("Agent warm-up failed: %s", str(e) or type(e).__name__)
+
+    async def _request_idempotent(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Performs an idempotent request (GET/DELETE) over the pooled client, retrying
+        502/503/504 responses and dropped connections with exponential backoff.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except RETRY_TRANSPORT_ERRORS:
+                # Pooled connections can be closed or sent GOAWAY by Cloud Run at any time.
+                if attempt == MAX_RETRIES:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    return response
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * (2 ** attempt))
     
-    def get_gcloud_auth_token(self) -> str:
+    def _cached_auth_token(self) -> Optional[str]:
+        """
+        Returns the cached identity token if it is not close to expiring.
+        """
+        if self._auth_token and self._auth_token_expiry - time.time() > TOKEN_REFRESH_MARGIN_SECONDS:
+            return self._auth_token
+        return None
+
+    def _fetch_identity_token(self) -> str:
         """
-        Uses the gcloud CLI to generate an identity token for authenticating with Cloud Run.
+        Fetches a new identity token for the agent's Cloud Run URL.
+        Uses Application Default Credentials (the metadata server on Cloud Run) and
+        falls back to the gcloud CLI for local user credentials, which cannot mint ID tokens.
         """
+        try:
+            return google.oauth2.id_token.fetch_id_token(self._auth_request, self.cloud_run_url)
+        except google_auth_exceptions.DefaultCredentialsError:
+            pass
+
         try:
             token = subprocess.check_output(
                 ["gcloud", "auth", "print-identity-token"],
@@ -28,11 +152,45 @@ class AgentService:
             ).strip()
             return token
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
-            print("Error: Failed to get gcloud auth token.")
-            print("Please ensure gcloud CLI is installed and authenticated (`gcloud auth login`).")
+            logger.error(
+                "Failed to get gcloud auth token. Please ensure Application Default "
+                "Credentials or the gcloud CLI are configured."
+            )
             raise Exception("gcloud command failed") from e
 
-    def get_or_create_session(
+    async def get_gcloud_auth_token(self) -> str:
+        """
+        Returns an identity token for authenticating with Cloud Run.
+        The token is cached until it is about to expire; the lock ensures concurrent
+        requests trigger a single refresh.
+        """
+        token = self._cached_auth_token()
+        if token:
+            return token
+
+        async with self._auth_token_lock:
+            # Another request may have refreshed the token while we waited.
+            token = self._cached_auth_token()
+            if token:
+                return token
+
+            token = await asyncio.to_thread(self._fetch_identity_token)
+            claims = google_jwt.decode(token, verify=False)
+            self._auth_token = token
+            self._auth_token_expiry = float(claims["exp"])
+            self._auth_headers = _build_headers(token)
+            return token
+
+    def _headers(self, auth_token: str, kind: str = "auth") -> Dict[str, str]:
+        """
+        Returns the "auth", "json" or "sse" headers for a token. Headers for the cached
+        token are built once per refresh and shared, so callers must not mutate them.
+        """
+        if auth_token == self._auth_token and self._auth_headers:
+            return self._auth_headers[kind]
+        return _build_headers(auth_token)[kind]
+
+    async def get_or_create_session(
         self,
         auth_token: str,
         app_name: str,
@@ -52,45 +210,44 @@ class AgentService:
         Returns:
             Tuple of (success: bool, session_id: str | None)
         """
-        headers = {"Authorization": f"Bearer {auth_token}"}
-        
         # Step 1: Request the list of sessions for the SPECIFIC user_id.
         list_sessions_url = f"{self.cloud_run_url}/apps/{app_name}/users/{user_id}/sessions"
-        print(f"Checking for existing sessions for user '{user_id}'...")
+        logger.debug("Checking for existing sessions for user '%s'...", user_id)
 
         try:
-            response = requests.get(list_sessions_url, headers=headers, timeout=60)
+            response = await self._request_idempotent(
+                "GET", list_sessions_url, headers=self._headers(auth_token), timeout=60.0
+            )
             response.raise_for_status()
             sessions_list = response.json()
             
             # Step 2: If the returned list is not empty, USE the first session.
             if sessions_list:
                 existing_session_id = sessions_list[0]['id']
-                print(f"Success: Found existing session '{existing_session_id}' for this user. Reusing it.")
+                logger.debug("Found existing session '%s' for user '%s'. Reusing it.", existing_session_id, user_id)
                 return True, existing_session_id
 
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred while checking for sessions: {e}")
+        except httpx.HTTPError as e:
+            logger.error("An error occurred while checking for sessions: %s", e)
             return False, None
 
         # Step 3: If the list was empty, CREATE a new session for that user.
-        print(f"No existing sessions found for user '{user_id}'. Creating a new one.")
+        logger.debug("No existing sessions found for user '%s'. Creating a new one.", user_id)
         create_session_url = f"{self.cloud_run_url}/apps/{app_name}/users/{user_id}/sessions/{new_session_id_if_needed}"
         
-        headers["Content-Type"] = "application/json"
         payload = {"state": {}}
 
         try:
-            response = requests.post(create_session_url, headers=headers, json=payload, timeout=60)
+            response = await self.client.post(create_session_url, headers=self._headers(auth_token, "json"), json=payload, timeout=60.0)
             response.raise_for_status()
-            print(f"Success: Created new session '{new_session_id_if_needed}'.")
+            logger.info("Created new session '%s' for user '%s'.", new_session_id_if_needed, user_id)
             return True, new_session_id_if_needed
             
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred while creating a new session: {e}")
+        except httpx.HTTPError as e:
+            logger.error("An error occurred while creating a new session: %s", e)
             return False, None
 
-    def run_agent_sse(
+    async def stream_agent_sse(
         self,
         auth_token: str,
         app_name: str,
@@ -98,17 +255,13 @@ class AgentService:
         user_id: str,
         session_id: str,
         use_streaming: bool = False
-    ) -> List[Dict]:
+    ) -> AsyncIterator[bytes]:
         """
-        Sends a prompt to the agent's /run_sse endpoint using an existing session.
+        Sends a prompt to the agent's /run_sse endpoint using an existing session and
+        yields the raw SSE bytes unchanged, as they arrive.
         """
         endpoint_url = f"{self.cloud_run_url}/run_sse"
-        headers = {
-            "Authorization": f"Bearer {auth_token}",
-            "Content-Type": "application/json"
-        }
-        if use_streaming:
-            headers["Accept"] = "text/event-stream"
+        headers = self._headers(auth_token, "sse" if use_streaming else "json")
 
         payload = {
             "app_name": app_name,
@@ -118,32 +271,185 @@ class AgentService:
             "streaming": use_streaming
         }
 
-        print(f"\nSending request to {endpoint_url}...")
-        print("--- Agent Response Stream ---")
-        all_events = []
+        logger.debug("Sending request to %s...", endpoint_url)
 
         try:
-            with requests.post(endpoint_url, headers=headers, json=payload, stream=use_streaming, timeout=300) as response:
+            async with self.client.stream("POST", endpoint_url, headers=headers, json=payload) as response:
+                if response.is_error:
+                    await response.aread()
+                    # A 404 means a stale cached session, which the callers retry.
+                    logger.log(
+                        logging.DEBUG if response.status_code == 404 else logging.ERROR,
+                        "HTTP Error running agent: %s %s. Response Body: %s",
+                        response.status_code, response.reason_phrase, response.text
+                    )
                 response.raise_for_status()
-                for line in response.iter_lines():
-                    if line and line.decode('utf-8').startswith('data: '):
-                        json_str = line.decode('utf-8')[len('data: '):]
-                        try:
-                            event = json.loads(json_str)
-                            all_events.append(event)
-                        except json.JSONDecodeError:
-                            print(f"Warning: Could not decode line: {json_str}")
-
-        except requests.exceptions.HTTPError as e:
-            print(f"\nHTTP Error running agent: {e.response.status_code} {e.response.reason}")
-            print(f"Response Body: {e.response.text}")
+                body = response.aiter_bytes()
+                while True:
+                    try:
+                        async with asyncio.timeout(SSE_READ_IDLE_TIMEOUT_SECONDS):
+                            chunk = await anext(body)
+                    except StopAsyncIteration:
+                        break
+                    yield chunk
+
+        except httpx.HTTPStatusError as e:
             raise e
-        except requests.exceptions.RequestException as e:
-            print(f"\nA request error occurred while running agent: {e}")
+        except TimeoutError as e:
+            logger.error("Agent sent no data for %ss, aborting request.", SSE_READ_IDLE_TIMEOUT_SECONDS)
+            raise AgentTimeoutError(
+                f"Agent stopped sending data for {SSE_READ_IDLE_TIMEOUT_SECONDS} seconds"
+            ) from e
+        except httpx.ReadTimeout as e:
+            logger.error("Agent did not respond, aborting request.")
+            raise AgentTimeoutError("Agent did not respond in time") from e
+        except httpx.HTTPError as e:
+            logger.error("A request error occurred while running agent: %s", e)
             raise e
 
+    async def run_agent_sse(
+        self,
+        auth_token: str,
+        app_name: str,
+        message: str,
+        user_id: str,
+        session_id: str,
+        use_streaming: bool = False
+    ) -> List[Dict]:
+        """
+        Sends a prompt to the agent's /run_sse endpoint using an existing session
+        and returns the decoded events once the stream is complete. Partial events
+        (streamed fragments of a model turn) are dropped; only complete events are kept.
+        """
+        all_events = []
+        pending = b""
+
+        def parse_line(line: bytes):
+            # Match the prefix on bytes; orjson parses the payload without decoding it first.
+            if not line.startswith(SSE_DATA_PREFIX):
+                return
+            json_bytes = line[len(SSE_DATA_PREFIX):].rstrip(b'\r')
+            try:
+                event = orjson.loads(json_bytes)
+                if not (isinstance(event, dict) and event.get("partial")):
+                    all_events.append(event)
+            except orjson.JSONDecodeError:
+                logger.warning("Could not decode line: %r", json_bytes)
+
+        async for chunk in self.stream_agent_sse(
+            auth_token=auth_token,
+            app_name=app_name,
+            message=message,
+            user_id=user_id,
+            session_id=session_id,
+            use_streaming=use_streaming
+        ):
+            # Chunks are not line-aligned: keep the trailing partial line for the next one.
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                parse_line(line)
+        parse_line(pending)
+
         return all_events
 
+    async def resolve_session(self, auth_token: str, user_id: str, new_session_id_if_needed: str) -> str:
+        """
+        Returns the agent session to use for a user, from the in-process cache when
+        possible, falling back to get_or_create_session on a miss.
+
+        Args:
+            auth_token: The gcloud authentication token.
+            user_id: The user identifier (email)
+            new_session_id_if_needed: The ID to use ONLY if a new session needs to be created.
+
+        Returns:
+            The session ID to use for this user
+        """
+        cached_session_id = self._session_cache.get(user_id)
+        if cached_session_id:
+            return cached_session_id
+
+        # Concurrent first messages from the same user resolve a single session.
+        async with self._session_locks[user_id]:
+            cached_session_id = self._session_cache.get(user_id)
+            if cached_session_id:
+                return cached_session_id
+
+            session_created, actual_session_id = await self.get_or_create_session(
+                auth_token=auth_token,
+                app_name=self.app_name,
+                user_id=user_id,
+                new_session_id_if_needed=new_session_id_if_needed
+            )
+
+            if not session_created:
+                raise Exception("Failed to create or retrieve session")
+
+            self._session_cache[user_id] = actual_session_id
+            return actual_session_id
+
+    def invalidate_session(self, user_id: str, session_id: Optional[str] = None):
+        """
+        Drops the cached session for a user. If session_id is given, the entry is only
+        dropped when it still points at that session.
+        """
+        if session_id is None or self._session_cache.get(user_id) == session_id:
+            self._session_cache.pop(user_id, None)
+
+    async def open_message_stream(self, user_id: str, session_id: str, message: str) -> Tuple[AsyncIterator[bytes], str]:
+        """
+        Send a message to the agent with streaming enabled.
+
+        The first chunk is awaited before returning so connection and HTTP errors
+        surface while the caller can still send a regular error response.
+
+        Args:
+            user_id: The user identifier (email)
+            session_id: The session identifier
+            message: The message to send to the agent
+
+        Returns:
+            Tuple of (raw SSE byte chunks, session ID actually used)
+        """
+        token = await self.get_gcloud_auth_token()
+        actual_session_id = await self.resolve_session(token, user_id, session_id)
+
+        def open_stream(stream_session_id: str) -> AsyncIterator[bytes]:
+            return self.stream_agent_sse(
+                auth_token=token,
+                app_name=self.app_name,
+                message=message,
+                user_id=user_id,
+                session_id=stream_session_id,
+                use_streaming=True
+            )
+
+        chunks = open_stream(actual_session_id)
+        try:
+            first_chunk = await anext(chunks, b"")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            # The cached session no longer exists on the agent: look it up again and retry once.
+            self.invalidate_session(user_id, actual_session_id)
+            actual_session_id = await self.resolve_session(token, user_id, session_id)
+            chunks = open_stream(actual_session_id)
+            first_chunk = await anext(chunks, b"")
+
+        async def replay() -> AsyncIterator[bytes]:
+            yield first_chunk
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            except (AgentTimeoutError, httpx.HTTPError) as e:
+                # The response has already started, so report the failure in-band
+                # with a terminal SSE event instead of cutting the connection.
+                logger.warning("Agent stream for user '%s' ended with an error: %s", user_id, e)
+                yield b"event: error\ndata: " + orjson.dumps({"error": str(e)}) + b"\n\n"
+
+        return replay(), actual_session_id
+
     async def send_message(self, user_id: str, session_id: str, message: str) -> List[Dict]:
         """
         Send a message to the agent and return the events.
@@ -158,35 +464,45 @@ class AgentService:
         """
         try:
             # Step 1: Get authentication token
-            token = self.get_gcloud_auth_token()
+            token = await self.get_gcloud_auth_token()
             
             # Step 2: Get or create session
-            session_created, actual_session_id = self.get_or_create_session(
-                auth_token=token,
-                app_name=self.app_name,
-                user_id=user_id,
-                new_session_id_if_needed=session_id
-            )
-            
-            if not session_created:
-                raise Exception("Failed to create or retrieve session")
+            actual_session_id = await self.resolve_session(token, user_id, session_id)
             
             # Step 3: Send message to agent
-            events = self.run_agent_sse(
-                auth_token=token,
-                app_name=self.app_name,
-                message=message,
-                user_id=user_id,
-                session_id=actual_session_id
-            )
+            try:
+                events = await self.run_agent_sse(
+                    auth_token=token,
+                    app_name=self.app_name,
+                    message=message,
+                    user_id=user_id,
+                    session_id=actual_session_id,
+                    # Streaming keeps bytes flowing during long model turns, so the
+                    # read-idle timeout only fires on a real stall.
+                    use_streaming=True
+                )
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    raise
+                # The cached session no longer exists on the agent: look it up again and retry once.
+                self.invalidate_session(user_id, actual_session_id)
+                actual_session_id = await self.resolve_session(token, user_id, session_id)
+                events = await self.run_agent_sse(
+                    auth_token=token,
+                    app_name=self.app_name,
+                    message=message,
+                    user_id=user_id,
+                    session_id=actual_session_id,
+                    use_streaming=True
+                )
             
             return events, actual_session_id
             
         except Exception as e:
-            print(f"Error in send_message: {e}")
+            logger.error("Error in send_message: %s", e)
             raise e
 
-    def delete_session(
+    async def delete_session(
         self,
         auth_token: str,
         app_name: str,
@@ -205,31 +521,30 @@ class AgentService:
         Returns:
             True if the session was deleted successfully, False otherwise.
         """
-        headers = {"Authorization": f"Bearer {auth_token}"}
-
         # Construct the specific URL for the session to be deleted, as per the docs.
         delete_url = f"{self.cloud_run_url}/apps/{app_name}/users/{user_id}/sessions/{session_id}"
-        print(f"Attempting to delete session: {delete_url}")
+        logger.debug("Attempting to delete session: %s", delete_url)
 
         try:
             # Make the DELETE request.
-            response = requests.delete(delete_url, headers=headers, timeout=60)
-
-            # This will raise an HTTPError for bad status codes (like 4xx or 5xx).
-            # A successful 204 No Content status from the server will NOT raise an error.
-            response.raise_for_status()
+            response = await self._request_idempotent(
+                "DELETE", delete_url, headers=self._headers(auth_token), timeout=60.0
+            )
+            if response.is_error:
+                # Errors like 404 (Not Found) or 401 (Unauthorized).
+                logger.error(
+                    "Failed to delete session. Status code: %s. Response Body: %s",
+                    response.status_code, response.text
+                )
+                return False
 
-            print(f"Success: Session '{session_id}' was deleted (Status Code: {response.status_code}).")
+            # A successful 204 No Content status from the server lands here.
+            logger.info("Session '%s' was deleted (Status Code: %s).", session_id, response.status_code)
             return True
 
-        except requests.exceptions.HTTPError as e:
-            # This block catches errors like 404 (Not Found) or 401 (Unauthorized).
-            print(f"HTTP Error: Failed to delete session. Status code: {e.response.status_code}")
-            print(f"Response Body: {e.response.text}")
-            return False
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             # This block catches other network-related errors (e.g., connection timeout).
-            print(f"An error occurred while deleting the session: {e}")
+            logger.error("An error occurred while deleting the session: %s", e)
             return False
 
     async def delete_user_session(self, user_id: str, session_id: str) -> bool:
@@ -245,18 +560,19 @@ class AgentService:
         """
         try:
             # Step 1: Get authentication token
-            token = self.get_gcloud_auth_token()
+            token = await self.get_gcloud_auth_token()
 
             # Step 2: Delete the session
-            success = self.delete_session(
+            success = await self.delete_session(
                 auth_token=token,
                 app_name=self.app_name,
                 user_id=user_id,
                 session_id=session_id
             )
+            self.invalidate_session(user_id, session_id)
 
             return success
 
         except Exception as e:
-            print(f"Error in delete_user_session: {e}")
+            logger.error("Error in delete_user_session: %s", e)
             return False
\ No newline at end of file
@@ -1,13 +1,19 @@
 import jwt
 import os
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from functools import lru_cache
+from typing import Optional, Tuple
 
 # JWT configuration
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "papers-rag-app")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
+# Precomputed once so signing/verification doesn't re-encode the key or rebuild the list per request
+_JWT_KEY = JWT_SECRET_KEY.encode("utf-8")
+_JWT_ALGORITHMS = [JWT_ALGORITHM]
+
 def create_jwt_token(user_email: str) -> str:
     """
     Create a JWT token for the given user email.
@@ -18,15 +24,44 @@ def create_jwt_token(user_email: str) -> str:
     Returns:
         JWT token string
     """
+    now = datetime.utcnow()
     payload = {
         "user_email": user_email,
-        "exp": datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS),
-        "iat": datetime.utcnow()
+        "exp": now + timedelta(hours=JWT_EXPIRATION_HOURS),
+        "iat": now
     }
     
-    token = jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+    token = jwt.encode(payload, _JWT_KEY, algorithm=JWT_ALGORITHM)
     return token
 
+@lru_cache(maxsize=8192)
+def _decode_jwt_token(token: str) -> Optional[Tuple[Optional[str], float]]:
+    """
+    Verify a JWT token's signature and claims, memoized on the raw token string.
+    Tokens are immutable, so a cached result stays valid for the current key;
+    call _decode_jwt_token.cache_clear() if JWT_SECRET_KEY ever changes at runtime.
+    
+    Args:
+        token: The JWT token to verify
+        
+    Returns:
+        Tuple of (user_email, exp timestamp) if the token is valid, None otherwise
+
+    Raises:
+        jwt.ImmatureSignatureError: If the token is not valid yet (e.g. "iat" slightly
+            in the future due to clock skew). Raised rather than returned so the
+            transient result is not cached.
+    """
+    try:
+        payload = jwt.decode(token, _JWT_KEY, algorithms=_JWT_ALGORITHMS)
+        return payload.get("user_email"), float(payload.get("exp", float("inf")))
+    except jwt.ImmatureSignatureError:
+        raise
+    except jwt.ExpiredSignatureError:
+        return None
+    except jwt.InvalidTokenError:
+        return None
+
 def verify_jwt_token(token: str) -> Optional[str]:
     """
     Verify and decode a JWT token.
@@ -38,10 +73,14 @@ def verify_jwt_token(token: str) -> Optional[str]:
         User email if token is valid, None otherwise
     """
     try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        user_email = payload.get("user_email")
-        return user_email
-    except jwt.ExpiredSignatureError:
+        claims = _decode_jwt_token(token)
+    except jwt.ImmatureSignatureError:
         return None
-    except jwt.InvalidTokenError:
-        return None
\ No newline at end of file
+    if claims is None:
+        return None
+
+    # A cached token may have expired since it was first verified
+    user_email, exp = claims
+    if exp <= time.time():
+        return None
+    return user_email
@@ -1,7 +1,33 @@
+import asyncio
 from google.cloud import firestore
 from google.cloud.firestore_v1 import AsyncClient
+import logging
 import os
-from typing import Optional
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+@firestore.async_transactional
+async def _add_user_if_admin(transaction, admin_ref, new_ref, user_data: dict) -> Tuple[bool, bool]:
+    """
+    Transaction body for FirestoreDB.add_user_as_admin.
+
+    Returns:
+        Tuple of (requester_is_admin: bool, user_added: bool)
+    """
+    # The two reads are independent, so issue them concurrently
+    admin_snap, new_snap = await asyncio.gather(
+        admin_ref.get(transaction=transaction),
+        new_ref.get(transaction=transaction)
+    )
+
+    if not admin_snap.exists or not admin_snap.to_dict().get("is_admin", False):
+        return False, False
+    if new_snap.exists:
+        return True, False
+
+    transaction.set(new_ref, user_data)
+    return True, True
 
 class FirestoreDB:
     """
@@ -16,77 +42,39 @@ class FirestoreDB:
         # In Google Cloud Run, credentials are automatically provided
         self.db = firestore.AsyncClient()
         self.collection_name = "rag_users"
-    
-    async def user_exists(self, user_email: str) -> bool:
-        """
-        Check if a user exists in the rag_users collection.
-
-        Args:
-            user_email: The email of the user to check
 
-        Returns:
-            True if user exists, False otherwise
-        """
-        try:
-            query = self.db.collection(self.collection_name).where("user_email", "==", user_email)
-            docs = await query.get()
-            return len(docs) > 0
-        except Exception as e:
-            print(f"Error checking if user exists: {e}")
-            return False
-    
-    async def is_user_admin(self, user_email: str) -> bool:
+    def _user_ref(self, user_email: str):
         """
-        Check if a user has admin privileges.
-
-        Args:
-            user_email: The email of the user to check
-
-        Returns:
-            True if user is admin, False otherwise
+        Users are stored with their email as the document ID, so lookups are point reads.
         """
-        try:
-            query = self.db.collection(self.collection_name).where("user_email", "==", user_email)
-            docs = await query.get()
-
-            if len(docs) > 0:
-                user_data = docs[0].to_dict()
-                return user_data.get("is_admin", False)
-            return False
-        except Exception as e:
-            print(f"Error checking if user is admin: {e}")
-            return False
+        return self.db.collection(self.collection_name).document(user_email)
     
-    async def add_user(self, user_email: str, is_admin: bool = False) -> bool:
+    async def add_user_as_admin(self, admin_email: str, user_email: str, is_admin: bool = False) -> Tuple[bool, bool]:
         """
-        Add a new user to the rag_users collection.
+        Add a new user on behalf of an admin in a single transaction, so the admin
+        check, the duplicate check and the write are atomic.
 
         Args:
+            admin_email: The email of the user requesting the addition
             user_email: The email of the user to add
-            is_admin: Whether the user should have admin privileges
+            is_admin: Whether the new user should have admin privileges
 
         Returns:
-            True if user was added successfully, False otherwise
+            Tuple of (requester_is_admin: bool, user_added: bool)
         """
-        try:
-            # Check if user already exists
-            query = self.db.collection(self.collection_name).where("user_email", "==", user_email)
-            docs = await query.get()
-            if len(docs) > 0:
-                return False  # User already exists
-
-            # Add the new user with auto-generated document ID
-            user_data = {
-                "user_email": user_email,
-                "is_admin": is_admin,
-                "created_at": firestore.SERVER_TIMESTAMP
-            }
+        user_data = {
+            "user_email": user_email,
+            "is_admin": is_admin,
+            "created_at": firestore.SERVER_TIMESTAMP
+        }
 
-            await self.db.collection(self.collection_name).add(user_data)
-            return True
-        except Exception as e:
-            print(f"Error adding user: {e}")
-            return False
+        # Errors propagate so the caller does not mistake them for a failed admin check.
+        return await _add_user_if_admin(
+            self.db.transaction(),
+            self._user_ref(admin_email),
+            self._user_ref(user_email),
+            user_data
+        )
     
     async def get_user(self, user_email: str) -> Optional[dict]:
         """
@@ -99,12 +87,11 @@ class FirestoreDB:
             User data dict if found, None otherwise
         """
         try:
-            query = self.db.collection(self.collection_name).where("user_email", "==", user_email)
-            docs = await query.get()
+            doc = await self._user_ref(user_email).get()
 
-            if len(docs) > 0:
-                return docs[0].to_dict()
+            if doc.exists:
+                return doc.to_dict()
             return None
         except Exception as e:
-            print(f"Error getting user: {e}")
+            logger.error("Error getting user: %s", e)
             return None
\ No newline at end of file
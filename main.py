@@ -1,48 +1,83 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict
 import uvicorn
 from typing import Optional
+import logging
 import os
 
 from auth import verify_jwt_token, create_jwt_token
 from firestore_db import FirestoreDB
-from agent_service import AgentService
+from agent_service import AgentService, AgentTimeoutError
 
-app = FastAPI(title="Papers RAG Web Backend", version="1.0.0")
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+
+app = FastAPI(
+    title="Papers RAG Web Backend",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # CORS middleware
+# Comma-separated frontend origins. Without it any origin is allowed, but without
+# credentials, since a wildcard origin cannot be combined with them.
+allowed_origins = [origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "").split(",") if origin.strip()]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=allowed_origins or ["*"],
+    allow_credentials=bool(allowed_origins),
+    allow_methods=["GET", "POST", "DELETE"],
+    allow_headers=["Authorization", "Content-Type"],
+    expose_headers=["X-Session-Id"],
+    # Let browsers cache preflight responses for a day
+    max_age=86400,
 )
 
 # Security
 security = HTTPBearer()
 
-# Initialize services
-db = FirestoreDB()
-agent_service = AgentService()
+# Services are created on startup, inside each worker's event loop
+db: Optional[FirestoreDB] = None
+agent_service: Optional[AgentService] = None
+
+@app.on_event("startup")
+async def startup():
+    global db, agent_service
+    db = FirestoreDB()
+    agent_service = AgentService()
+    await agent_service.start()
+    await agent_service.warm_up()
+
+@app.on_event("shutdown")
+async def shutdown():
+    if agent_service is not None:
+        await agent_service.close()
 
 # Pydantic models
-class LoginRequest(BaseModel):
+class RequestModel(BaseModel):
+    # Reject unknown keys and trim surrounding whitespace from strings (e.g. emails)
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
+
+class LoginRequest(RequestModel):
     user_email: str
 
-class AddUserRequest(BaseModel):
+class AddUserRequest(RequestModel):
     user_email: str
     new_user_email: str
     is_admin: bool
 
-class MessageToAgentRequest(BaseModel):
+class MessageToAgentRequest(RequestModel):
     user_email: str
     session_id: str
     message_to_agent: str
 
-class DeleteSessionRequest(BaseModel):
+class DeleteSessionRequest(RequestModel):
     user_email: str
     session_id: str
 
@@ -103,8 +138,10 @@ async def login(request: LoginRequest):
 @app.post("/add_user", response_model=StandardResponse)
 async def add_user(request: AddUserRequest, current_user: str = Depends(get_current_user)):
     try:
-        # Check if current user is admin
-        is_admin = await db.is_user_admin(current_user)
+        # Check admin rights and add the new user in one Firestore transaction
+        is_admin, success = await db.add_user_as_admin(
+            current_user, request.new_user_email, request.is_admin
+        )
         
         if not is_admin:
             return StandardResponse(
@@ -112,9 +149,6 @@ async def add_user(request: AddUserRequest, current_user: str = Depends(get_curr
                 message="Only admin users can add new users"
             )
         
-        # Add new user to Firestore
-        success = await db.add_user(request.new_user_email, request.is_admin)
-        
         if success:
             return StandardResponse(
                 status="success",
@@ -133,7 +167,7 @@ async def add_user(request: AddUserRequest, current_user: str = Depends(get_curr
         )
 
 @app.post("/message_to_agent", response_model=MessageToAgentResponse)
-async def message_to_agent(request: MessageToAgentRequest, current_user: str = Depends(get_current_user)):
+async def message_to_agent(request: MessageToAgentRequest, response: Response, current_user: str = Depends(get_current_user)):
     try:
         # Send message to agent using the provided sample code logic
         events, actual_session_id = await agent_service.send_message(
@@ -142,10 +176,12 @@ async def message_to_agent(request: MessageToAgentRequest, current_user: str = D
             message=request.message_to_agent
         )
         
-        if events and len(events) > 0:
-            # Get the response message from the last event
-            response_message = events[-1]["content"]["parts"][0]["text"]
-            
+        # Get the response message from the last event, without raising on partial events
+        last_event = events[-1] if events else {}
+        parts = (last_event.get("content") or {}).get("parts") or [{}]
+        response_message = parts[0].get("text")
+
+        if response_message is not None:
             return MessageToAgentResponse(
                 status="success",
                 message=response_message,
@@ -158,6 +194,13 @@ async def message_to_agent(request: MessageToAgentRequest, current_user: str = D
                 session_id=request.session_id
             )
     
+    except AgentTimeoutError as e:
+        response.status_code = status.HTTP_504_GATEWAY_TIMEOUT
+        return MessageToAgentResponse(
+            status="fail",
+            message=f"Error communicating with agent: {str(e)}",
+            session_id=request.session_id
+        )
     except Exception as e:
         return MessageToAgentResponse(
             status="fail",
@@ -165,6 +208,40 @@ async def message_to_agent(request: MessageToAgentRequest, current_user: str = D
             session_id=request.session_id
         )
 
+@app.post("/message_to_agent_stream")
+async def message_to_agent_stream(request: MessageToAgentRequest, response: Response, current_user: str = Depends(get_current_user)):
+    try:
+        # Open the agent stream; errors before the first chunk are reported as JSON
+        chunks, actual_session_id = await agent_service.open_message_stream(
+            user_id=request.user_email,
+            session_id=request.session_id,
+            message=request.message_to_agent
+        )
+    except AgentTimeoutError as e:
+        response.status_code = status.HTTP_504_GATEWAY_TIMEOUT
+        return MessageToAgentResponse(
+            status="fail",
+            message=f"Error communicating with agent: {str(e)}",
+            session_id=request.session_id
+        )
+    except Exception as e:
+        return MessageToAgentResponse(
+            status="fail",
+            message=f"Error communicating with agent: {str(e)}",
+            session_id=request.session_id
+        )
+
+    # Forward the agent's SSE events unchanged as they arrive
+    return StreamingResponse(
+        chunks,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Session-Id": actual_session_id
+        }
+    )
+
 @app.delete("/delete_session", response_model=StandardResponse)
 async def delete_session(request: DeleteSessionRequest, current_user: str = Depends(get_current_user)):
     try:
@@ -204,4 +281,11 @@ async def health_check():
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
\ No newline at end of file
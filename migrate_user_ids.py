@@ -0,0 +1,45 @@
+"""
+One-shot migration: re-key rag_users documents on the user's email.
+
+Older deployments stored users under auto-generated document IDs and looked
+them up with a `user_email` query. FirestoreDB now reads and writes
+`rag_users/{user_email}` directly, so existing documents must be copied to
+email-keyed IDs.
+
+Usage:
+    python migrate_user_ids.py           # dry run, prints planned changes
+    python migrate_user_ids.py --apply   # copy documents and delete the old ones
+"""
+import sys
+from google.cloud import firestore
+
+COLLECTION_NAME = "rag_users"
+
+def migrate(apply: bool) -> None:
+    db = firestore.Client()
+    collection = db.collection(COLLECTION_NAME)
+
+    for doc in collection.stream():
+        user_data = doc.to_dict()
+        user_email = user_data.get("user_email")
+
+        if not user_email:
+            print(f"Skipping '{doc.id}': no user_email field")
+            continue
+        if doc.id == user_email:
+            continue
+
+        target_ref = collection.document(user_email)
+        if target_ref.get().exists:
+            print(f"Skipping '{doc.id}': '{user_email}' already exists")
+            continue
+
+        print(f"{'Migrating' if apply else 'Would migrate'} '{doc.id}' -> '{user_email}'")
+        if apply:
+            batch = db.batch()
+            batch.set(target_ref, user_data)
+            batch.delete(doc.reference)
+            batch.commit()
+
+if __name__ == "__main__":
+    migrate(apply="--apply" in sys.argv[1:])